@@ -1,12 +1,85 @@
 import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+from datetime import datetime, timezone
 import eyed3
+import hashlib
+import hmac
+import io
 import json
+import math
 from mutagen.mp4 import MP4, MP4Tags, MP4Cover
 import os
 from PIL import Image
+import random
 import re
+import requests
+import requests.adapters
+import shutil
+import signal
+import socket
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from typing import Callable
+import urllib.parse
+import uuid
+import weakref
+import xml.etree.ElementTree as ElementTree
+
+stall_timeout = 60 # seconds without the byte counter moving before a download is killed and retried
+download_retries = 2
+start_timeout = 600 # seconds allowed before the first progress line, extraction and rate limit waits can be slow
+
+# How many of each stage can run at once, semaphores are made per event loop by get_stage()
+stage_limits = {"lookup": 4, "download": 1, "verify": 2, "tag": 2, "split": 4, "upload": 2}
+stages = weakref.WeakKeyDictionary()
+
+# Items are downloaded and tagged in here, then renamed into the output folder once they're finished
+staging_folder_name = ".ytdownloader-staging"
+staging_max_age = 6 * 60 * 60 # seconds, anything older is left over from a crashed run
+
+# Remote images (e.g. an --icon URL) are cached here by content hash, see fetch_image()
+http_timeout = (5, 30) # seconds to connect, seconds between bytes
+image_cache_folder = os.path.join(tempfile.gettempdir(), "YTDownloader", "images")
+image_extensions = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/x-icon": ".ico", "image/vnd.microsoft.icon": ".ico"}
+http_session = None
+http_session_lock = threading.Lock()
+image_cache_lock = threading.Lock()
+fetched_images = {}
+failed_images = {} # url: error, so an unreachable image is only tried once per run
+
+# Worker mode, see run_worker(). A worker that stops heartbeating loses its items after queue_lease_time
+queue_lease_time = 300 # seconds
+queue_poll_time = 10 # seconds between checks for new or expired items while other workers are busy
+queue_max_attempts = 3
+swept_folders = set()
+
+# Caps used to pick formats for every download, see choose_formats(). All None means yt-dlp's default choice
+format_policy = {"max_height": None, "max_abr": None, "codecs": None, "max_size": None}
+
+# --watch, see run_watch(). Each check lists the playlist flat and only downloads ids missing from the last snapshot
+watch_interval = 60 # minutes between checks of a playlist, unless its line in the watch list says otherwise
+watch_jitter = 0.1 # checks are spread by up to this fraction of the interval so playlists don't all poll together
+
+# --sink, see publish_file(). Finished files are streamed to object storage from the staging folder
+output_sink = None # {"scheme", "bucket", "prefix", "endpoint", "region", "access_key", "secret_key", "session_token"}
+sink_part_size = 16 * 1024 * 1024
+sink_parallel_parts = 4 # parts of one file uploaded at once, so up to this many parts are held in memory per upload
+sink_delete_local = False
+s3_min_part_size = 5 * 1024 * 1024 # S3 rejects smaller parts, apart from the last one
+
+# --verify, see verify_file()
+verify_downloads = False
+verify_duration_tolerance = 2 # seconds, or 1% of the duration if that's more
+verify_tail_seconds = 10 # how much of the end of the file is decoded
+hash_buffer_size = 4 * 1024 * 1024
+
+progress_template = "download:[progress] %(progress.status)s %(progress.downloaded_bytes)s %(progress.total_bytes)s %(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s"
 
 def sanitise_text(text:str):
     text = text.replace(':', ' -')
@@ -14,9 +87,11 @@ def sanitise_text(text:str):
 
 def convert_ico_to_png(ico_path):
     try:
+        # A temp file of its own per call, tags run in parallel and each deletes its copy when it's done
         img = Image.open(ico_path)
-        png_path = ico_path.replace(".ico", ".png")
-        img.save(png_path, format="PNG")
+        png_file, png_path = tempfile.mkstemp(suffix=".png")
+        with os.fdopen(png_file, "wb") as png_output:
+            img.save(png_output, format="PNG")
         return png_path
     except Exception as e:
         log_progress(0, 0, f"Failed converting .ico to .png. {e}", "")
@@ -29,18 +104,204 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+def get_http_session() -> requests.Session:
+    # One pooled session for the whole run so repeated requests to the same server reuse connections
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=2)
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+        return http_session
+
+def is_url(path) -> bool:
+    return isinstance(path, str) and path.lower().startswith(("http://", "https://"))
+
+def read_image_cache_index() -> dict:
+    try:
+        with open(os.path.join(image_cache_folder, "index.json"), "r", encoding="utf-8") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+def write_cache_file(path, data:bytes):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as cache_file:
+        cache_file.write(data)
+    os.replace(temp_path, path)
+
+def fetch_image(url) -> str:
+    # Returns the path of a local copy of the image at url. Copies are stored by the hash of their content,
+    # and revalidated with ETag/Last-Modified once per run, so tracks sharing cover art share one download
+    with image_cache_lock:
+        if url in fetched_images and os.path.exists(fetched_images[url]):
+            return fetched_images[url]
+        if url in failed_images: # Don't make every track wait out the same timeout again
+            raise requests.RequestException(f"{failed_images[url]} (earlier in this run)")
+        try:
+            return fetch_image_locked(url)
+        except (requests.RequestException, OSError) as e:
+            failed_images[url] = e
+            raise
+
+def fetch_image_locked(url) -> str:
+    # The download and caching part of fetch_image, called with image_cache_lock held
+    os.makedirs(image_cache_folder, exist_ok=True)
+    cached = read_image_cache_index().get(url)
+    headers = {}
+    if cached and os.path.exists(os.path.join(image_cache_folder, cached["file"])):
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = get_http_session().get(url, headers=headers, timeout=http_timeout)
+    if response.status_code == 304:
+        fetched_images[url] = os.path.join(image_cache_folder, cached["file"])
+        return fetched_images[url]
+    response.raise_for_status() # Error if not found
+
+    image_data = response.content
+    content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    extension = image_extensions.get(content_type) or os.path.splitext(urllib.parse.urlparse(url).path)[1].lower() or ".png"
+    if extension == ".ico": # Tags can't hold .ico, convert once here rather than on every tag
+        png_data = io.BytesIO()
+        Image.open(io.BytesIO(image_data)).save(png_data, format="PNG")
+        image_data = png_data.getvalue()
+        extension = ".png"
+
+    file_name = hashlib.sha256(image_data).hexdigest() + extension
+    image_path = os.path.join(image_cache_folder, file_name)
+    if not os.path.exists(image_path):
+        write_cache_file(image_path, image_data)
+
+    index = read_image_cache_index() # Re-read in case another process has added to it
+    index[url] = {"file": file_name, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    write_cache_file(os.path.join(image_cache_folder, "index.json"), json.dumps(index).encode("utf-8"))
+    fetched_images[url] = image_path
+    return image_path
+
+def parse_sink(url:str) -> dict:
+    # s3://bucket/prefix, the endpoint and credentials are filled in by main()
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in sink_uploaders or not parts.netloc:
+        raise argparse.ArgumentTypeError(f"invalid sink '{url}', use s3://bucket/prefix")
+    prefix = parts.path.strip("/")
+    return {"scheme": parts.scheme, "bucket": parts.netloc, "prefix": prefix + "/" if prefix else ""}
+
+def s3_authorization(method, path, query_string, headers:dict, amz_date) -> str:
+    # AWS Signature Version 4, signing every header that is sent. path and query_string are already URI encoded
+    canonical_headers = "".join(f"{name.lower()}:{str(value).strip()}\n" for name, value in sorted(headers.items(), key=lambda header: header[0].lower()))
+    signed_headers = ";".join(sorted(name.lower() for name in headers))
+    canonical_request = "\n".join([method, path, query_string, canonical_headers, signed_headers, headers["x-amz-content-sha256"]])
+    scope = f"{amz_date[:8]}/{output_sink['region']}/s3/aws4_request"
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()])
+    key = ("AWS4" + output_sink["secret_key"]).encode("utf-8")
+    for scope_part in scope.split("/"):
+        key = hmac.new(key, scope_part.encode("utf-8"), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"AWS4-HMAC-SHA256 Credential={output_sink['access_key']}/{scope}, SignedHeaders={signed_headers}, Signature={signature}"
+
+def s3_request(method, key, query:dict=None, data:bytes=b"") -> requests.Response:
+    # Path style (endpoint/bucket/key) so it works with MinIO and other S3-compatible servers as well as AWS
+    endpoint = urllib.parse.urlsplit(output_sink["endpoint"])
+    path = "/" + urllib.parse.quote(f"{output_sink['bucket']}/{key}", safe="/-_.~")
+    query_string = "&".join(f"{urllib.parse.quote(name, safe='-_.~')}={urllib.parse.quote(str(value), safe='-_.~')}" for name, value in sorted((query or {}).items()))
+    amz_date = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    headers = {"Host": endpoint.netloc, "x-amz-date": amz_date, "x-amz-content-sha256": hashlib.sha256(data).hexdigest()}
+    if output_sink.get("session_token"):
+        headers["x-amz-security-token"] = output_sink["session_token"]
+    headers["Authorization"] = s3_authorization(method, path, query_string, headers, amz_date)
+    url = f"{endpoint.scheme}://{endpoint.netloc}{path}" + (f"?{query_string}" if query_string else "")
+    response = get_http_session().request(method, url, data=data, headers=headers, timeout=http_timeout)
+    response.raise_for_status()
+    return response
+
+def s3_response_xml(response:requests.Response) -> ElementTree.Element:
+    # Anything that isn't XML (an empty body, a proxy's error page) is a failed request, so the item is retried
+    try:
+        return ElementTree.fromstring(response.content)
+    except ElementTree.ParseError:
+        raise requests.HTTPError(f"Unexpected response from {response.url}: {response.text[:200]!r}", response=response)
+
+def upload_to_s3(file_path, key):
+    # Small files go up in one request, bigger ones as a multipart upload with sink_parallel_parts parts in flight
+    size = os.path.getsize(file_path)
+    if size <= sink_part_size:
+        with open(file_path, "rb") as upload_file:
+            s3_request("PUT", key, data=upload_file.read())
+        return
+
+    response = s3_request("POST", key, {"uploads": ""})
+    upload_id = s3_response_xml(response).findtext("{*}UploadId")
+    if not upload_id:
+        raise requests.HTTPError(f"Starting the upload of {key} gave no UploadId: {response.text[:200]!r}", response=response)
+
+    def upload_part(part_number):
+        with open(file_path, "rb") as upload_file: # Own handle per part, so parts are read straight from disk as they're sent
+            upload_file.seek((part_number - 1) * sink_part_size)
+            data = upload_file.read(sink_part_size)
+        response = s3_request("PUT", key, {"partNumber": part_number, "uploadId": upload_id}, data)
+        if "ETag" not in response.headers:
+            raise requests.HTTPError(f"Part {part_number} of {key} was accepted without an ETag", response=response)
+        return response.headers["ETag"]
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(sink_parallel_parts) as pool:
+            try:
+                etags = list(pool.map(upload_part, range(1, math.ceil(size / sink_part_size) + 1)))
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+                raise
+        parts = "".join(f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>" for number, etag in enumerate(etags, start=1))
+        response = s3_request("POST", key, {"uploadId": upload_id}, f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode("utf-8"))
+        if s3_response_xml(response).tag.endswith("Error"): # S3 can fail the completion after answering 200
+            raise requests.HTTPError(f"Completing the upload of {key} failed: {response.text}", response=response)
+    except BaseException:
+        with contextlib.suppress(requests.RequestException):
+            s3_request("DELETE", key, {"uploadId": upload_id}) # Otherwise the uploaded parts are kept (and billed)
+        raise
+
+# Uploaders by --sink URL scheme, each takes (local file path, key) and raises on failure
+sink_uploaders = {"s3": upload_to_s3}
+
+async def publish_file(staged_path, file_path, item_num, total_items, title) -> str:
+    # Puts a finished, tagged file at file_path, streaming it to the --sink first if there is one.
+    # With --verify, returns the sha256 of exactly what is published
+    digest = None
+    if verify_downloads:
+        async with get_stage("verify"):
+            digest = await asyncio.to_thread(hash_file, staged_path)
+    if output_sink:
+        key = output_sink["prefix"] + f"{os.path.basename(os.path.dirname(os.path.abspath(file_path)))}/{os.path.basename(file_path)}"
+        async with get_stage("upload"):
+            log_progress(item_num, total_items, "Uploading", title)
+            try:
+                await asyncio.to_thread(sink_uploaders[output_sink["scheme"]], staged_path, key)
+            except requests.RequestException as e:
+                log_progress(0, 0, f"Failed uploading {key}. {e}", "")
+                raise
+        if sink_delete_local:
+            os.remove(staged_path)
+            return digest
+    os.replace(staged_path, file_path) # Only ever a whole, tagged file at the final path
+    return digest
+
 def is_playlist(url) -> bool:
     return "playlist" in url
 
-def log_progress(item_num, total_items, state, title):
+def log_progress(item_num, total_items, state, title, keep_line:bool=False):
     if total_items == 0:
         sys.stdout.write(state)
-    elif total_items == 1:
+    elif total_items == 1 or item_num is None:
         sys.stdout.write(f"\r{state}: {title}\033[K") # \033[K is an ANSI code to clear the whole cmd line
+    elif total_items is None:
+        sys.stdout.write(f"\r{state} item {item_num}: {title}\033[K")
     else:
         sys.stdout.write(f"\r{state} item {item_num} of {total_items}: {title}\033[K")
     sys.stdout.flush()
-    if "Completed" in state or "Fail" in state:
+    if keep_line or "Completed" in state or "Fail" in state:
         print()
 
 def determine_output_folder(output_folder, album=None, is_mp3:bool=False):
@@ -52,20 +313,77 @@ def determine_output_folder(output_folder, album=None, is_mp3:bool=False):
     elif is_mp3:
         base_folder = "downloads/audio"
 
-    if not os.path.exists(base_folder):
-        os.makedirs(base_folder)
+    os.makedirs(base_folder, exist_ok=True) # Other workers may be making it at the same time
     return base_folder
 
-def get_video_title(video_url):
+def make_staging_folder(output_folder) -> str:
+    # Inside the output folder so it's on the same filesystem and os.replace is an atomic rename
+    staging_folder = os.path.join(output_folder, staging_folder_name, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+    os.makedirs(staging_folder)
+    return staging_folder
+
+def sweep_staging(output_folder):
+    staging_root = os.path.join(output_folder, staging_folder_name)
+    if not os.path.isdir(staging_root):
+        return
+    now = time.time()
+    for name in os.listdir(staging_root):
+        staging_folder = os.path.join(staging_root, name)
+        try:
+            # A running job keeps writing to its files, so only the newest mtime says whether it's abandoned
+            last_modified = max([os.path.getmtime(staging_folder)] + [os.path.getmtime(os.path.join(staging_folder, file)) for file in os.listdir(staging_folder)])
+        except OSError:
+            continue
+        if now - last_modified > staging_max_age:
+            shutil.rmtree(staging_folder, ignore_errors=True)
+
+def get_stage(name) -> asyncio.Semaphore:
+    loop_stages = stages.setdefault(asyncio.get_running_loop(), {})
+    if name not in loop_stages:
+        loop_stages[name] = asyncio.Semaphore(stage_limits[name])
+    return loop_stages[name]
+
+async def start_process(command) -> asyncio.subprocess.Process:
+    # A new process group/session lets stop_process take down ffmpeg children along with yt-dlp
+    return await asyncio.create_subprocess_exec(*command,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        creationflags=subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0,
+        start_new_session=os.name != "nt")
+
+async def stop_process(process:asyncio.subprocess.Process):
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/T", "/F", "/PID", str(process.pid)], capture_output=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        else:
+            os.killpg(process.pid, signal.SIGTERM)
+        await asyncio.wait_for(process.wait(), 5)
+    except (ProcessLookupError, asyncio.TimeoutError):
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+async def run_command(command) -> str:
+    process = await start_process(command)
+    try:
+        stdout, _ = await process.communicate()
+    finally:
+        await stop_process(process) # Only does anything if we were cancelled part way through
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return stdout.decode("utf-8", errors="replace")
+
+async def get_video_title(video_url):
     try:
         command = ["yt-dlp", "-e", video_url]  # The '-e' option extracts the video title
-        result = subprocess.run(command, capture_output=True, text=True, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        title = result.stdout.strip()
+        async with get_stage("lookup"):
+            title = (await run_command(command)).strip()
         return title
     except subprocess.CalledProcessError:
         return "Unknown"
     
-def get_video_thumbnail(video_url, output_folder):
+async def get_video_thumbnail(video_url, output_folder):
     try:
         os.makedirs(output_folder, exist_ok=True)
 
@@ -73,10 +391,12 @@ def get_video_thumbnail(video_url, output_folder):
             "yt-dlp",
             "--skip-download",
             "--write-thumbnail",
+            "--convert-thumbnails", "jpg", # Tags only know jpg and png, YouTube thumbnails are often webp
             "-o", f"{output_folder}/%(title)s.%(ext)s",
             video_url
         ]
-        subprocess.run(command, check=True)
+        async with get_stage("lookup"):
+            await run_command(command)
 
         for file in os.listdir(output_folder):
             if file.endswith((".jpg", ".png", ".webp")):
@@ -90,8 +410,105 @@ def get_video_thumbnail(video_url, output_folder):
         log_progress(0, 0, f"Failed to download thumbnail for {video_url}. {e}", "")
         return None
 
+def parse_progress_line(line:str):
+    # Lines look like "[progress] downloading 1048576 4194304 NA 524288.0 6", see progress_template
+    fields = line.split()
+    if len(fields) != 7 or fields[0] != "[progress]":
+        return None
+
+    def to_number(value):
+        try:
+            return float(value)
+        except ValueError: # yt-dlp prints NA for unknown values
+            return None
+
+    total = to_number(fields[3])
+    if total is None:
+        total = to_number(fields[4])
+    return {
+        "status": fields[1],
+        "downloaded_bytes": to_number(fields[2]),
+        "total_bytes": total,
+        "speed": to_number(fields[5]),
+        "eta": to_number(fields[6]),
+    }
+
+def format_bytes(num) -> str:
+    if num is None:
+        return "?"
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if num < 1024:
+            return f"{num:.1f}{unit}"
+        num /= 1024
+    return f"{num:.1f}TiB"
+
+def format_item_progress(progress:dict) -> str:
+    text = f"{format_bytes(progress['downloaded_bytes'])} of {format_bytes(progress['total_bytes'])}"
+    if progress["speed"]:
+        text += f" at {format_bytes(progress['speed'])}/s"
+    if progress["eta"] is not None:
+        text += f", ETA {int(progress['eta'])}s"
+    return text
+
+async def run_download_command(command, item_num, total_items, title, on_progress:Callable=None) -> bool:
+    command = command + ["--progress", "--newline", "--progress-template", progress_template]
+    for attempt in range(download_retries + 1):
+        process = await start_process(command)
+        last_bytes = None
+        last_change = time.monotonic()
+        started = False # No progress yet, yt-dlp is still extracting
+        armed = False
+        stalled = False
+        try:
+            while True: # Read line by line, never buffer the whole output
+                # Post-processing (ffmpeg) prints no progress, so only watch while bytes are expected
+                if armed:
+                    timeout = max(0, stall_timeout - (time.monotonic() - last_change))
+                elif not started:
+                    timeout = max(0, start_timeout - (time.monotonic() - last_change))
+                else:
+                    timeout = None
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), timeout)
+                except asyncio.TimeoutError:
+                    stalled = True
+                    break
+                if not line:
+                    break
+                progress = parse_progress_line(line.decode("utf-8", errors="replace"))
+                if not progress:
+                    continue
+                started = True
+                if progress["downloaded_bytes"] != last_bytes:
+                    last_bytes = progress["downloaded_bytes"]
+                    last_change = time.monotonic()
+                armed = progress["status"] != "finished"
+                if on_progress:
+                    on_progress(progress)
+                else:
+                    log_progress(item_num, total_items, "Downloading", f"{title} ({format_item_progress(progress)})")
+            if not stalled:
+                await process.wait()
+        finally:
+            await stop_process(process)
+
+        if stalled:
+            if attempt < download_retries:
+                log_progress(item_num, total_items, f"Stalled for {stall_timeout if started else start_timeout}s, retrying ({attempt + 1} of {download_retries})", title)
+            continue
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return True
+    raise subprocess.CalledProcessError(-1, command)
+
 def update_metadata(is_mp3:bool, file_path, title, album=None, chapter=None, artist=None, year=None, icon_path=None, url=None):
     try:
+        if is_url(icon_path):
+            try:
+                icon_path = fetch_image(icon_path)
+            except (requests.RequestException, OSError) as e:
+                log_progress(0, 0, f"Failed to fetch icon {icon_path}. {e}", "")
+                icon_path = None
         if is_mp3:
             audiofile_tmp = eyed3.load(file_path)
             if not audiofile_tmp:
@@ -165,10 +582,167 @@ def update_metadata(is_mp3:bool, file_path, title, album=None, chapter=None, art
     except Exception as e:
         log_progress(0, 0, f"Failed to update metadata for {file_path}. {e}", "")
 
-def download_mp3(video_url, output_folder, item_num=None, total_items=None, album=None, chapter=None, artist=None, year=None, icon_path=None, title=None) -> bool:
+def hash_file(file_path) -> str:
+    # Big reads into one reused buffer, so hashing a large file doesn't hold it in memory or make lots of small reads
+    digest = hashlib.sha256()
+    buffer = bytearray(hash_buffer_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as media_file:
+        while True:
+            read = media_file.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+def read_expected_duration(duration_path):
+    try:
+        with open(duration_path, "r", encoding="utf-8") as duration_file:
+            return float(duration_file.read().split()[0])
+    except (OSError, ValueError, IndexError): # yt-dlp writes NA when it doesn't know
+        return None
+
+async def verify_file(file_path, expected_duration, item_num, total_items, title) -> bool:
+    # False if the file is truncated or corrupt
+    try:
+        output = await run_command(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_path])
+        duration = float(output.strip())
+    except (subprocess.CalledProcessError, ValueError):
+        log_progress(item_num, total_items, "Failed verifying, can't read the container of", title)
+        return False
+    if expected_duration and abs(duration - expected_duration) > max(verify_duration_tolerance, expected_duration * 0.01):
+        log_progress(item_num, total_items, f"Failed verifying, {duration:.0f}s long instead of {expected_duration:.0f}s for", title)
+        return False
+    try:
+        # A cut off file usually still probes fine, decoding the end of it is what finds the damage
+        await run_command(["ffmpeg", "-v", "error", "-xerror", "-sseof", f"-{verify_tail_seconds}", "-i", file_path, "-f", "null", "-"])
+    except subprocess.CalledProcessError:
+        log_progress(item_num, total_items, "Failed verifying, can't decode the end of", title)
+        return False
+    return True
+
+async def download_verified(command, staged_path, item_num, total_items, title):
+    # Downloads and, with --verify, checks the file in the verify stage so the next download can start meanwhile.
+    # A failed download, or a file that fails the checks, is downloaded again
+    duration_path = f"{staged_path}.duration"
+    if verify_downloads:
+        command = command + ["--print-to-file", "%(duration)s", duration_path] # Expected duration, without another lookup
+    for attempt in range(download_retries + 1):
+        try:
+            async with get_stage("download"):
+                log_progress(item_num, total_items, "Downloading", title)
+                await run_download_command(command, item_num, total_items, title)
+        except subprocess.CalledProcessError as e:
+            # -1 is run_download_command giving up after retrying stalls itself, anything else is yt-dlp failing
+            if e.returncode == -1 or attempt >= download_retries:
+                raise
+            log_progress(item_num, total_items, f"Download failed (exit code {e.returncode}), retrying ({attempt + 1} of {download_retries})", title, keep_line=True)
+            continue
+        if not verify_downloads or ("--dateafter" in command and not os.path.exists(staged_path)): # Skipped by date
+            return
+
+        async with get_stage("verify"):
+            log_progress(item_num, total_items, "Verifying", title)
+            verified = await verify_file(staged_path, read_expected_duration(duration_path), item_num, total_items, title)
+        if verified:
+            return
+        with contextlib.suppress(OSError):
+            os.remove(staged_path) # Otherwise yt-dlp sees it's already there and skips the download
+        if attempt < download_retries:
+            log_progress(item_num, total_items, f"Retrying download ({attempt + 1} of {download_retries}) of", title, keep_line=True)
+    raise subprocess.CalledProcessError(-1, command)
+
+def completed_state(state, digest) -> str:
+    return f"{state} (sha256 {digest})" if digest else state
+
+def estimate_format_size(format_info:dict, duration) -> float:
+    # yt-dlp only knows the exact size for some formats, otherwise work it out from the bitrate (kbit/s)
+    size = format_info.get("filesize") or format_info.get("filesize_approx")
+    if not size and format_info.get("tbr") and duration:
+        size = format_info["tbr"] * 1000 / 8 * duration
+    return size or 0
+
+def codec_rank(codec, preferences:list[str]) -> int:
+    # Lower is better, codecs not in the preference list come last
+    for rank, preference in enumerate(preferences):
+        if codec and codec.lower().startswith(preference):
+            return rank
+    return len(preferences)
+
+def choose_formats(info:dict, is_mp3:bool, policy:dict):
+    # Returns (format spec for -f, expected bytes, description), or None to leave it to yt-dlp
+    formats = info.get("formats") or []
+    duration = info.get("duration")
+    preferences = policy.get("codecs") or []
+    audio = [f for f in formats if f.get("acodec") not in (None, "none") and f.get("vcodec") in (None, "none")]
+    if policy.get("max_abr"):
+        audio = [f for f in audio if (f.get("abr") or 0) <= policy["max_abr"]]
+    audio.sort(key=lambda f: (codec_rank(f.get("acodec"), preferences), -(f.get("abr") or f.get("tbr") or 0)))
+    max_bytes = (policy.get("max_size") or 0) * 1024 * 1024
+
+    if is_mp3:
+        if not audio:
+            return None
+        # Best audio that fits, or the smallest if none of them do
+        fitting = [f for f in audio if not max_bytes or estimate_format_size(f, duration) <= max_bytes]
+        chosen = fitting[0] if fitting else min(audio, key=lambda f: estimate_format_size(f, duration))
+        return chosen["format_id"], estimate_format_size(chosen, duration), f"{chosen.get('acodec')} {chosen.get('abr') or '?'}kbps"
+
+    video = [f for f in formats if f.get("vcodec") not in (None, "none") and f.get("acodec") in (None, "none")]
+    combined = [f for f in formats if f.get("vcodec") not in (None, "none") and f.get("acodec") not in (None, "none")]
+    if policy.get("max_height"):
+        video = [f for f in video if (f.get("height") or 0) <= policy["max_height"]]
+        combined = [f for f in combined if (f.get("height") or 0) <= policy["max_height"]]
+    if policy.get("max_abr"):
+        combined = [f for f in combined if (f.get("abr") or 0) <= policy["max_abr"]]
+    # Stick to mp4/m4a when there are any, they merge into an mp4 that can be tagged without remuxing
+    video = [f for f in video if f.get("ext") == "mp4"] or video
+    audio = [f for f in audio if f.get("ext") == "m4a"] or audio
+    combined = [f for f in combined if f.get("ext") == "mp4"] or combined
+
+    # Candidates are (video format, audio format), with None for the audio of a combined format
+    candidates = [(v, a) for v in video for a in audio] + [(c, None) for c in combined]
+    if not candidates:
+        return None
+    def candidate_rank(candidate):
+        video_format, audio_format = candidate
+        audio_format = audio_format or video_format
+        return (codec_rank(video_format.get("vcodec"), preferences), -(video_format.get("height") or 0), -(video_format.get("tbr") or 0),
+            codec_rank(audio_format.get("acodec"), preferences), -(audio_format.get("abr") or audio_format.get("tbr") or 0))
+    def candidate_size(candidate):
+        return sum(estimate_format_size(f, duration) for f in candidate if f)
+    candidates.sort(key=candidate_rank)
+    fitting = [candidate for candidate in candidates if not max_bytes or candidate_size(candidate) <= max_bytes]
+    chosen = fitting[0] if fitting else min(candidates, key=candidate_size)
+    chosen_video, chosen_audio = chosen
+    if not chosen_audio:
+        description = f"{chosen_video.get('height') or '?'}p {chosen_video.get('vcodec')} with {chosen_video.get('acodec')} audio"
+        return chosen_video["format_id"], candidate_size(chosen), description
+    description = f"{chosen_video.get('height') or '?'}p {chosen_video.get('vcodec')} + {chosen_audio.get('acodec')} {chosen_audio.get('abr') or '?'}kbps"
+    return f"{chosen_video['format_id']}+{chosen_audio['format_id']}", candidate_size(chosen), description
+
+async def get_format_args(video_url, is_mp3:bool, item_num, total_items, title, info:dict=None) -> list[str]:
+    default_args = [] if is_mp3 else ["-f", "bestaudio[ext=m4a]+bestvideo[ext=mp4]/best"]
+    if not any(format_policy.values()):
+        return default_args
+
+    if not info or not info.get("formats"): # Pass in info that's already been extracted to save another lookup
+        info = await get_video_info(video_url)
+    chosen = choose_formats(info, is_mp3, format_policy)
+    if not chosen:
+        log_progress(item_num, total_items, "No format matched the format options, using the default for", title, keep_line=True)
+        return default_args
+    format_spec, expected_bytes, description = chosen
+    log_progress(item_num, total_items, f"Format {format_spec} ({description}, about {format_bytes(expected_bytes)}) for", title, keep_line=True)
+    if format_policy.get("max_size") and expected_bytes > format_policy["max_size"] * 1024 * 1024:
+        log_progress(item_num, total_items, "Nothing fits in --max-size, using the smallest format for", title, keep_line=True)
+    return ["-f", format_spec] + ([] if is_mp3 else ["--merge-output-format", "mp4"])
+
+async def download_mp3(video_url, output_folder, item_num=None, total_items=None, album=None, chapter=None, artist=None, year=None, icon_path=None, title=None, date_after=None) -> bool:
+    staging_folder = None
     try:
         if not album:
-            album = get_video_title(video_url)
+            album = await get_video_title(video_url)
         
         title_set = "Unknown"
         if title:
@@ -178,36 +752,46 @@ def download_mp3(video_url, output_folder, item_num=None, total_items=None, albu
         elif album:
             title_set = album
         else:
-            title_set = get_video_title(video_url)
+            title_set = await get_video_title(video_url)
         title_set = sanitise_text(title_set)
 
-        log_progress(item_num, total_items, "Downloading", title_set)
+        format_args = await get_format_args(video_url, True, item_num, total_items, title_set)
+        staging_folder = make_staging_folder(output_folder)
         command = [
             "yt-dlp",
             "-q", "--no-warnings",
+            *format_args,
+            *(["--dateafter", date_after] if date_after else []),
             "-x", "--audio-format", "mp3",
-            "-o", f"{output_folder}/{title_set}.%(ext)s",
+            "-o", f"{staging_folder}/{title_set}.%(ext)s",
             video_url
         ]
-        subprocess.run(command, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        staged_path = f"{staging_folder}/{title_set}.mp3"
+        await download_verified(command, staged_path, item_num, total_items, title_set)
+        if date_after and not os.path.exists(staged_path): # yt-dlp found it was uploaded before --since and skipped it
+            log_progress(item_num, total_items, f"Skipped (uploaded before {date_after})", title_set, keep_line=True)
+            return True
+
+        async with get_stage("tag"):
+            log_progress(item_num, total_items, "Updating metadata for", title_set)
+            await asyncio.to_thread(update_metadata, True, staged_path, title_set, album, chapter, artist, year, icon_path, video_url)
 
-        log_progress(item_num, total_items, "Updating metadata for", title_set)
-        file_path = f"{output_folder}/{title_set}.mp3"
-        update_metadata(True, file_path, title_set, album, chapter, artist, year, icon_path, video_url)
+        digest = await publish_file(staged_path, f"{output_folder}/{title_set}.mp3", item_num, total_items, title_set)
 
-        log_progress(item_num, total_items, "Completed", title_set)
+        log_progress(item_num, total_items, completed_state("Completed", digest), title_set)
         return True
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         log_progress(item_num, total_items, "Failed processing", title_set)
         return False
+    finally:
+        if staging_folder:
+            shutil.rmtree(staging_folder, ignore_errors=True)
 
-def download_mp4(video_url, output_folder, item_num=None, total_items=None, album=None, chapter=None, artist=None, year=None, icon_path=None, title=None) -> bool:
+async def download_mp4(video_url, output_folder, item_num=None, total_items=None, album=None, chapter=None, artist=None, year=None, icon_path=None, title=None, date_after=None) -> bool:
+    staging_folder = None
     try:
         if not album:
-            album = get_video_title(video_url)
-
-        if not icon_path:
-            icon_path = get_video_thumbnail(video_url, output_folder)
+            album = await get_video_title(video_url)
 
         title_set = "Unknown"
         if title:
@@ -217,94 +801,548 @@ def download_mp4(video_url, output_folder, item_num=None, total_items=None, albu
         elif album:
             title_set = album
         else:
-            title_set = get_video_title(video_url)
+            title_set = await get_video_title(video_url)
         title_set = sanitise_text(title_set)
 
-        log_progress(item_num, total_items, "Downloading", title_set)
+        staging_folder = make_staging_folder(output_folder)
+        if not icon_path:
+            icon_path = await get_video_thumbnail(video_url, staging_folder)
+
+        format_args = await get_format_args(video_url, False, item_num, total_items, title_set)
         command = [
             "yt-dlp",
             "-q", "--no-warnings",
-            "-f", "bestaudio[ext=m4a]+bestvideo[ext=mp4]/best",
-            "-o", f"{output_folder}/{title_set}.%(ext)s",
+            *format_args,
+            *(["--dateafter", date_after] if date_after else []),
+            "-o", f"{staging_folder}/{title_set}.%(ext)s",
             video_url
         ]
-        subprocess.run(command, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        staged_path = f"{staging_folder}/{title_set}.mp4"
+        await download_verified(command, staged_path, item_num, total_items, title_set)
+        if date_after and not os.path.exists(staged_path): # yt-dlp found it was uploaded before --since and skipped it
+            log_progress(item_num, total_items, f"Skipped (uploaded before {date_after})", title_set, keep_line=True)
+            return True
+
+        async with get_stage("tag"):
+            log_progress(item_num, total_items, "Updating metadata for", title_set)
+            await asyncio.to_thread(update_metadata, False, staged_path, title_set, album, chapter, artist, year, icon_path, video_url)
 
-        log_progress(item_num, total_items, "Updating metadata for", title_set)
-        file_path = f"{output_folder}/{title_set}.mp4"
-        update_metadata(False, file_path, title_set, album, chapter, artist, year, icon_path, video_url)
+        digest = await publish_file(staged_path, f"{output_folder}/{title_set}.mp4", item_num, total_items, title_set)
 
-        log_progress(item_num, total_items, "Completed processing for", title_set)
+        log_progress(item_num, total_items, completed_state("Completed processing for", digest), title_set)
         return True
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         log_progress(item_num, total_items, "Failed processing", title_set)
         return False
+    finally:
+        if staging_folder:
+            shutil.rmtree(staging_folder, ignore_errors=True)
+
+async def get_video_info(video_url) -> dict:
+    try:
+        command = ["yt-dlp", "-J", "--no-warnings", video_url]
+        async with get_stage("lookup"):
+            return json.loads(await run_command(command))
+    except (subprocess.CalledProcessError, ValueError):
+        log_progress(0, 0, f"Failed to get video info for {video_url}", "")
+        return {}
+
+async def cut_chapter(source_path, chapter_path, start, end, is_mp3:bool):
+    # Stream copy, so it's only as slow as copying the bytes. -ss/-t before -i seeks the input rather than decoding up to it
+    command = [
+        "ffmpeg",
+        "-v", "error", "-y",
+        "-ss", str(start),
+        "-t", str(end - start),
+        "-i", source_path,
+        *(["-map", "0:a"] if is_mp3 else ["-map", "0:v?", "-map", "0:a?"]),
+        "-c", "copy",
+        "-map_chapters", "-1",
+        chapter_path
+    ]
+    async with get_stage("split"):
+        await run_command(command)
+
+async def split_chapters(video_url, output_folder, is_mp3:bool, album=None, artist=None, year=None, icon_path=None, set_chapters=False, info:dict=None) -> bool:
+    staging_folder = None
+    title_set = video_url
+    try:
+        if info is None:
+            info = await get_video_info(video_url)
+        chapters = info.get("chapters") or []
+        if not chapters:
+            log_progress(0, 0, f"No chapters found for {video_url}, downloading it as one file", "", keep_line=True)
+            if is_mp3:
+                return await download_mp3(video_url, output_folder, 1, 1, album, None, artist, year, icon_path)
+            return await download_mp4(video_url, output_folder, 1, 1, album, None, artist, year, icon_path)
+
+        if not album:
+            album = info.get("title") or "Unknown"
+        title_set = sanitise_text(album)
+        extension = "mp3" if is_mp3 else "mp4"
+
+        staging_folder = make_staging_folder(output_folder)
+        if not icon_path: # Every track gets the same cover art
+            icon_path = await get_video_thumbnail(video_url, staging_folder)
+
+        # Downloaded once, every chapter is cut out of this one file
+        format_args = await get_format_args(video_url, is_mp3, None, None, title_set, info)
+        command = [
+            "yt-dlp",
+            "-q", "--no-warnings",
+            *format_args,
+            *(["-x", "--audio-format", "mp3"] if is_mp3 else ["--merge-output-format", "mp4"]),
+            "-o", f"{staging_folder}/source.%(ext)s",
+            video_url
+        ]
+        source_path = f"{staging_folder}/source.{extension}"
+        await download_verified(command, source_path, None, None, title_set)
+
+        total_items = len(chapters)
+
+        async def process_chapter(num, chapter):
+            chapter_title = chapter.get("title") or f"Chapter {num}"
+            if set_chapters:
+                file_title = sanitise_text(f"{album} Chapter {num}")
+            else: # Chapter names repeat (e.g. "Interlude"), the track number keeps the files apart and in order
+                file_title = sanitise_text(f"{num:0{len(str(total_items))}} {chapter_title}")
+            chapter_path = f"{staging_folder}/{file_title}.{extension}"
+
+            log_progress(num, total_items, "Splitting", file_title)
+            await cut_chapter(source_path, chapter_path, chapter["start_time"], chapter["end_time"], is_mp3)
+            async with get_stage("tag"):
+                log_progress(num, total_items, "Updating metadata for", file_title)
+                await asyncio.to_thread(update_metadata, is_mp3, chapter_path, chapter_title, album, num, artist, year, icon_path, video_url)
+
+            digest = await publish_file(chapter_path, f"{output_folder}/{file_title}.{extension}", num, total_items, file_title)
+            log_progress(num, total_items, completed_state("Completed", digest), file_title)
+
+        tasks = [asyncio.create_task(process_chapter(num, chapter)) for num, chapter in enumerate(chapters, start=1)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # One chapter failing (or a Ctrl+C) stops the rest before the staging folder is removed from under them
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return True
+    except (subprocess.CalledProcessError, OSError):
+        log_progress(None, None, "Failed processing", title_set)
+        return False
+    finally:
+        if staging_folder:
+            shutil.rmtree(staging_folder, ignore_errors=True)
 
-def get_playlist_title(url) -> str:
+async def get_playlist_title(url) -> str:
     try:
         command = [
             "yt-dlp",
             "--flat-playlist",
+            "--playlist-items", "1", # Only the playlist's own title is needed, so don't enumerate every entry
             "-J",  # Output JSON
             url
         ]
-        result = subprocess.run(command, capture_output=True, text=True, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        data = json.loads(result.stdout)
+        async with get_stage("lookup"):
+            data = json.loads(await run_command(command))
         return sanitise_text(data.get("title", "Unnamed Playlist"))
     except subprocess.CalledProcessError:
         return "Unnamed Playlist"
 
-def get_playlist_urls(playlist_url) -> list[str]:
+def parse_date(text:str) -> str:
+    # Accepts YYYYMMDD or YYYY-MM-DD, returns YYYYMMDD to match yt-dlp's upload_date
     try:
-        command = [
-            "yt-dlp",
-            "--flat-playlist",
-            "-J",  # Output JSON
-            playlist_url
-        ]
-        result = subprocess.run(command, capture_output=True, text=True, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        data = json.loads(result.stdout)
-        video_urls = [f"https://www.youtube.com/watch?v={entry['id']}" for entry in data['entries']]
-        return video_urls
-    except subprocess.CalledProcessError:
-        log_progress(0, 0, "Failed extracting playlist videos", "")
+        return datetime.strptime(text.replace("-", ""), "%Y%m%d").strftime("%Y%m%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date '{text}', use YYYYMMDD or YYYY-MM-DD")
+
+def parse_title_regex(text:str) -> re.Pattern:
+    # Checked up front so a typo is reported before anything is looked up
+    try:
+        return re.compile(text, re.IGNORECASE)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(f"invalid regex '{text}', {e}")
+
+def selection_args(selection:dict) -> list[str]:
+    # The parts of the selection yt-dlp can apply itself while enumerating
+    if not selection:
         return []
-    
-def process_playlist(url, output_dir=None, dl_mp3=None, album=None, artist=None, year=None, set_chapters=False, icon_path=None):
+    args = []
+    if selection.get("items"):
+        args += ["--playlist-items", selection["items"]]
+    if selection.get("since"):
+        args += ["--dateafter", selection["since"]]
+    if selection.get("since") or selection.get("newest"):
+        # YouTube listings only have dates (worked out from "3 weeks ago") when asked, see entry_date()
+        args += ["--extractor-args", "youtubetab:approximate_date"]
+    if selection.get("max_duration"):
+        args += ["--match-filter", f"duration <=? {selection['max_duration']}"] # <=? lets entries without a duration through
+    return args
+
+def entry_date(entry:dict) -> str:
+    # YYYYMMDD, flat entries often only have a timestamp, or nothing at all
+    if entry.get("upload_date"):
+        return entry["upload_date"]
+    if entry.get("timestamp"):
+        return datetime.fromtimestamp(entry["timestamp"], timezone.utc).strftime("%Y%m%d")
+    return None
+
+def entry_date_after(entry:dict, selection:dict) -> str:
+    # An entry listed without a date gets --since checked again by the download, which has the real date
+    if selection and selection.get("since") and not entry_date(entry):
+        return selection["since"]
+    return None
+
+def entry_selected(entry:dict, selection:dict) -> bool:
+    # Flat entries don't always have every field, so only reject what we know doesn't match
+    if not selection:
+        return True
+    if selection.get("since") and entry_date(entry) and entry_date(entry) < selection["since"]:
+        return False
+    if selection.get("max_duration") and entry.get("duration") and entry["duration"] > selection["max_duration"]:
+        return False
+    if selection.get("title_regex") and not selection["title_regex"].search(entry.get("title") or ""):
+        return False
+    return True
+
+def newest_entries(entries:list[dict], count:int) -> list[dict]:
+    # Newest by upload date when the listing has dates, otherwise the first listed (channels list their newest first)
+    if any(entry_date(entry) for entry in entries):
+        by_date = sorted(entries, key=lambda entry: (entry_date(entry) or "", entry.get("timestamp") or 0), reverse=True)
+        newest = by_date[:count]
+        return [entry for entry in entries if entry in newest] # Back into playlist order
+    return entries[:count]
+
+async def select_playlist_entries(playlist_url, selection:dict=None, status:dict=None):
+    async with contextlib.aclosing(iter_playlist_entries(playlist_url, selection_args(selection), status)) as entries:
+        if not selection or not selection.get("newest"):
+            async for entry in entries:
+                if entry_selected(entry, selection):
+                    yield entry
+            return
+
+        # Newest N can only be known once every (flat, so cheap) entry has been listed
+        listed = [entry async for entry in entries if entry_selected(entry, selection)]
+    for entry in newest_entries(listed, selection["newest"]):
+        yield entry
+
+async def iter_playlist_entries(playlist_url, extra_args:list[str]=None, status:dict=None):
+    # -j prints one JSON object per entry as soon as it is found, unlike -J which waits for the whole playlist.
+    # status gets "complete", False when yt-dlp failed part way and the entries so far are only some of them
+    command = [
+        "yt-dlp",
+        "--flat-playlist",
+        "-j",
+        *(extra_args or []),
+        playlist_url
+    ]
+    process = await start_process(command)
+    try:
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+        await process.wait()
+    finally:
+        await stop_process(process)
+    if status is not None:
+        status["complete"] = process.returncode == 0
+    if process.returncode != 0:
+        log_progress(0, 0, "Failed extracting playlist videos", "")
+
+async def process_playlist_item(url, entry_title, output_dir, dl_mp3, num, total_items, album, artist, year, set_chapters, icon_path, date_after=None):
+    # always set chapter number, but if not set_chapter, dont put chapter in name
+    chap = num
+    title = None
+    if not set_chapters:
+        title = entry_title or await get_video_title(url)
+
+    if dl_mp3:
+        return await download_mp3(url, output_dir, num, total_items, album, chap, artist, year, icon_path, title, date_after)
+    return await download_mp4(url, output_dir, num, total_items, album, chap, artist, year, icon_path, title, date_after)
+
+async def process_entries(entries, output_dir, dl_mp3, album, artist, year, set_chapters, icon_path, selection:dict=None) -> dict:
+    # entries is an async iterator of flat playlist entries, returns whether each entry's id was downloaded
+    # Items are queued while the playlist is still being enumerated, so the first download starts straight away
+    queue = asyncio.Queue(maxsize=stage_limits["lookup"] * 2)
+    results = {}
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            entry_id, item_args = item
+            results[entry_id] = await process_playlist_item(*item_args)
+
+    workers = [asyncio.create_task(worker()) for _ in range(stage_limits["download"] + stage_limits["lookup"])]
+    try:
+        num = 0
+        async for entry in entries:
+            num += 1
+            entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+            chap = entry.get("playlist_index") or num
+            total_items = entry.get("playlist_count") # None when yt-dlp doesn't know the size up front
+            await queue.put((entry["id"], (entry_url, entry.get("title"), output_dir, dl_mp3, chap, total_items, album, artist, year, set_chapters, icon_path, entry_date_after(entry, selection))))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+    return results
+
+async def process_playlist(url, output_dir=None, dl_mp3=None, album=None, artist=None, year=None, set_chapters=False, icon_path=None, selection:dict=None):
     if not album:
-        album = get_playlist_title(url)
+        album = await get_playlist_title(url)
         output_dir = determine_output_folder(output_dir, album, dl_mp3)
 
-    urls = get_playlist_urls(url)
-    if not urls:
+    async with contextlib.aclosing(select_playlist_entries(url, selection)) as entries:
+        await process_entries(entries, output_dir, dl_mp3, album, artist, year, set_chapters, icon_path, selection)
+
+async def read_inputs(url, is_mp3, output_dir_=None, album_=None, artist_=None, year_=None, chapter_=None, set_chapters_=None, icon_=None, selection_:dict=None, split_chapters_=False):
+    if split_chapters_ and not is_playlist(url):
+        info = await get_video_info(url)
+        # The tracks make up an album, so without -o or -a they go in a folder named after the video
+        output_dir = determine_output_folder(output_dir_, album_ or info.get("title"), is_mp3)
+        sweep_staging(output_dir)
+        await split_chapters(url, output_dir, is_mp3, album_, artist_, year_, icon_, set_chapters_, info)
         return
-    
-    total_items = len(urls)
-    for num, url in enumerate(urls, start=1):
-        # always set chapter number, but if not set_chapter, dont put chapter in name
-        chap = num
-        title = None
-        if not set_chapters:
-            title = get_video_title(url)
-
-        if dl_mp3:
-            download_mp3(url, output_dir, num, total_items, album, chap, artist, year, icon_path, title)
-        else:
-            download_mp4(url, output_dir, num, total_items, album, chap, artist, year, icon_path, title)
 
-def read_inputs(url, is_mp3, output_dir_=None, album_=None, artist_=None, year_=None, chapter_=None, set_chapters_=None, icon_=None):
     output_dir = determine_output_folder(output_dir_, album_, is_mp3)
+    sweep_staging(output_dir)
     album = None
     if album_:
         album = album_
     if is_playlist(url):
         if not album_:
-            album = get_playlist_title(url)
-        process_playlist(url, output_dir, is_mp3, album, artist_, year_, set_chapters_, icon_)
+            album = await get_playlist_title(url)
+        await process_playlist(url, output_dir, is_mp3, album, artist_, year_, set_chapters_, icon_, selection_)
     elif is_mp3:
-        download_mp3(url, output_dir, 1, 1, album, chapter_, artist_, year_, icon_)
+        await download_mp3(url, output_dir, 1, 1, album, chapter_, artist_, year_, icon_)
     else:
-        download_mp4(url, output_dir, 1, 1, album, chapter_, artist_, year_, icon_)
+        await download_mp4(url, output_dir, 1, 1, album, chapter_, artist_, year_, icon_)
+
+def queue_connect(queue_path) -> sqlite3.Connection:
+    # No WAL, it doesn't work on network filesystems. isolation_level=None so transactions are explicit
+    connection = sqlite3.connect(queue_path, timeout=30, isolation_level=None)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY,
+            video_url TEXT NOT NULL,
+            output_folder TEXT NOT NULL,
+            options TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            lease_owner TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (video_url, output_folder, options)
+        )""")
+    return connection
+
+def queue_add(queue_path, items:list[tuple]) -> int:
+    # items are (video_url, output_folder, options dict), anything already queued is ignored
+    with contextlib.closing(queue_connect(queue_path)) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        added = 0
+        for video_url, output_folder, options in items:
+            cursor = connection.execute("INSERT OR IGNORE INTO items (video_url, output_folder, options) VALUES (?, ?, ?)",
+                (video_url, output_folder, json.dumps(options, sort_keys=True)))
+            added += cursor.rowcount
+        connection.execute("COMMIT")
+        return added
+
+def queue_lease(queue_path, worker_id) -> dict:
+    # Takes the next pending item, or one whose lease ran out because its worker died
+    now = time.time()
+    with contextlib.closing(queue_connect(queue_path)) as connection:
+        connection.execute("BEGIN IMMEDIATE") # Locks out other workers until COMMIT, so an item is only leased once
+        connection.execute("UPDATE items SET state = 'failed' WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, queue_max_attempts))
+        row = connection.execute("""
+            SELECT id, video_url, output_folder, options FROM items
+            WHERE (state = 'pending' OR (state = 'leased' AND lease_expires < ?)) AND attempts < ?
+            ORDER BY id LIMIT 1""", (now, queue_max_attempts)).fetchone()
+        if row:
+            connection.execute("UPDATE items SET state = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now + queue_lease_time, row[0]))
+        connection.execute("COMMIT")
+    if not row:
+        return None
+    return {"id": row[0], "video_url": row[1], "output_folder": row[2], "options": json.loads(row[3])}
+
+def queue_heartbeat(queue_path, worker_id, item_id) -> bool:
+    # False means the lease expired and another worker may have the item now
+    with contextlib.closing(queue_connect(queue_path)) as connection:
+        cursor = connection.execute("UPDATE items SET lease_expires = ? WHERE id = ? AND state = 'leased' AND lease_owner = ?",
+            (time.time() + queue_lease_time, item_id, worker_id))
+        return cursor.rowcount == 1
+
+def queue_finish(queue_path, worker_id, item_id, success:bool):
+    with contextlib.closing(queue_connect(queue_path)) as connection:
+        if success:
+            state = "'done'"
+        else: # Give it back for another go, unless it's had all of its attempts
+            state = f"CASE WHEN attempts >= {queue_max_attempts} THEN 'failed' ELSE 'pending' END"
+        connection.execute(f"UPDATE items SET state = {state}, lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?",
+            (item_id, worker_id))
+
+def queue_unfinished(queue_path) -> int:
+    with contextlib.closing(queue_connect(queue_path)) as connection:
+        return connection.execute("SELECT COUNT(*) FROM items WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+async def enqueue_inputs(queue_path, url, is_mp3, output_dir_=None, album_=None, artist_=None, year_=None, chapter_=None, set_chapters_=None, icon_=None, selection_:dict=None):
+    output_dir = determine_output_folder(output_dir_, album_, is_mp3)
+    options = {"is_mp3": is_mp3, "album": album_, "artist": artist_, "year": year_, "icon": icon_}
+    if not is_playlist(url):
+        added = await asyncio.to_thread(queue_add, queue_path, [(url, output_dir, dict(options, chapter=chapter_))])
+        log_progress(0, 0, f"Queued {added} item(s)", "", keep_line=True)
+        return
+
+    if not album_:
+        options["album"] = await get_playlist_title(url)
+    added = 0
+    batch = []
+    num = 0
+    async with contextlib.aclosing(select_playlist_entries(url, selection_)) as entries:
+        async for entry in entries:
+            num += 1
+            # The title is fixed now so every worker names the file the same way
+            title = None if set_chapters_ else entry.get("title")
+            item_options = dict(options, chapter=entry.get("playlist_index") or num, title=title)
+            if entry_date_after(entry, selection_): # Only when needed, so items queued before still match as duplicates
+                item_options["date_after"] = entry_date_after(entry, selection_)
+            batch.append((f"https://www.youtube.com/watch?v={entry['id']}", output_dir, item_options))
+            if len(batch) >= 100:
+                added += await asyncio.to_thread(queue_add, queue_path, batch)
+                batch = []
+    if batch:
+        added += await asyncio.to_thread(queue_add, queue_path, batch)
+    log_progress(0, 0, f"Queued {added} item(s)", "", keep_line=True)
+
+async def process_queue_item(queue_path, worker_id, item:dict) -> bool:
+    options = item["options"]
+    output_folder = determine_output_folder(item["output_folder"])
+    if output_folder not in swept_folders:
+        swept_folders.add(output_folder)
+        sweep_staging(output_folder)
+
+    download = download_mp3 if options["is_mp3"] else download_mp4
+    task = asyncio.create_task(download(item["video_url"], output_folder, options["chapter"], None,
+        options["album"], options["chapter"], options["artist"], options["year"], options["icon"], options.get("title"), options.get("date_after")))
+
+    # Keep the lease alive while the item is being worked on, give up on it if the lease is lost
+    while not task.done():
+        await asyncio.wait([task], timeout=queue_lease_time / 3)
+        if not task.done() and not await asyncio.to_thread(queue_heartbeat, queue_path, worker_id, item["id"]):
+            task.cancel()
+            log_progress(0, 0, f"Lost the lease on {item['video_url']}, leaving it to another worker", "", keep_line=True)
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            return False
+
+    success = task.result()
+    await asyncio.to_thread(queue_finish, queue_path, worker_id, item["id"], success)
+    return success
+
+async def run_worker(queue_path):
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+    async def work():
+        while True:
+            item = await asyncio.to_thread(queue_lease, queue_path, worker_id)
+            if item:
+                await process_queue_item(queue_path, worker_id, item)
+            elif await asyncio.to_thread(queue_unfinished, queue_path):
+                await asyncio.sleep(queue_poll_time) # Others are still working, their items come back if they die
+            else:
+                return
+
+    await asyncio.gather(*[work() for _ in range(stage_limits["download"])])
+
+def read_watch_list(watch_path) -> list[dict]:
+    # One playlist URL per line, optionally followed by the minutes between checks. Lines starting with # are ignored
+    playlists = []
+    with open(watch_path, "r", encoding="utf-8") as watch_file:
+        for line in watch_file:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            minutes = float(fields[1]) if len(fields) > 1 else watch_interval
+            playlists.append({"url": fields[0], "interval": minutes * 60})
+    return playlists
+
+def read_watch_state(state_path) -> dict:
+    try:
+        with open(state_path, "r", encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+async def run_watch(watch_path, is_mp3, output_dir_=None, album_=None, artist_=None, year_=None, set_chapters_=None, icon_=None, selection_:dict=None, baseline_=False):
+    playlists = read_watch_list(watch_path)
+    state_path = os.path.splitext(watch_path)[0] + ".state.json"
+    state = read_watch_state(state_path) # {url: {"ids": ids already downloaded in playlist order, "album": title, "checked": bool}}
+
+    async def check(url):
+        snapshot = state.setdefault(url, {"ids": [], "album": None})
+        first_check = not (snapshot.get("checked") or snapshot["ids"]) # Saved a listing before, not just tried to
+        status = {}
+        async with get_stage("lookup"): # Holds a lookup slot so a long watch list doesn't start dozens of yt-dlps at once
+            async with contextlib.aclosing(select_playlist_entries(url, selection_, status)) as entries:
+                listing = [entry async for entry in entries]
+        if not status.get("complete"): # A listing cut short would look like known items were removed
+            log_progress(0, 0, f"Listing {url} failed, keeping the last snapshot until the next check", "", keep_line=True)
+            return
+        ids = [entry["id"] for entry in listing]
+        if not ids: # Can also be a listing that failed without saying so, so don't throw the snapshot away
+            log_progress(0, 0, f"Nothing listed for {url}, keeping the last snapshot", "", keep_line=True)
+            return
+        if ids == snapshot["ids"]:
+            log_progress(0, 0, f"No changes in {snapshot['album'] or url}", "", keep_line=True)
+            return
+
+        known = set(snapshot["ids"])
+        new_entries = [entry for entry in listing if entry["id"] not in known]
+        downloaded = {}
+        if first_check and baseline_:
+            downloaded = {entry["id"]: True for entry in new_entries}
+            log_progress(0, 0, f"Recorded {len(new_entries)} existing item(s) in {url}", "", keep_line=True)
+        elif new_entries:
+            album = album_ or snapshot["album"] or await get_playlist_title(url)
+            snapshot["album"] = album
+            # Every playlist gets its own folder, inside -o if it was given
+            output_dir = determine_output_folder(os.path.join(output_dir_, sanitise_text(album)) if output_dir_ else None, album, is_mp3)
+            if output_dir not in swept_folders:
+                swept_folders.add(output_dir)
+                sweep_staging(output_dir)
+            log_progress(0, 0, f"{len(new_entries)} new item(s) in {album}", "", keep_line=True)
+
+            async def new_items():
+                for entry in new_entries:
+                    yield entry
+            downloaded = await process_entries(new_items(), output_dir, is_mp3, album, artist_, year_, set_chapters_, icon_, selection_)
+
+        # Failed ids are left out so the next check tries them again, removed ones drop out with the listing
+        snapshot["ids"] = [entry_id for entry_id in ids if entry_id in known or downloaded.get(entry_id)]
+        snapshot["checked"] = True
+        write_cache_file(state_path, json.dumps(state, indent=1).encode("utf-8"))
+
+    async def watch(playlist):
+        while True:
+            try:
+                await check(playlist["url"])
+            except Exception as e: # Anything going wrong with one playlist mustn't stop the others being watched
+                log_progress(0, 0, f"Failed checking {playlist['url']}. {e!r}", "")
+            await asyncio.sleep(playlist["interval"] * random.uniform(1 - watch_jitter, 1 + watch_jitter))
+
+    if not playlists:
+        log_progress(0, 0, f"No playlists to watch in {watch_path}", "", keep_line=True)
+        return
+    await asyncio.gather(*[watch(playlist) for playlist in playlists])
 
 def usage():
     print("Usage: ./YTDownloader [-h] [-a ALBUM] [-A ARTIST] [-c CHAPTER] [-C] [-i ICON] [-n NAME] [-o OUTPUT] [-u URL] [-v] [-y YEAR]")
@@ -315,11 +1353,49 @@ def usage():
     print("  -A, --artist          <NAME>  Artist name for metadata.")
     print("  -c, --chapter         <NUM>   Chapter number for non-playlist downloads.")
     print("  -C, --set-chapters            Set chapters for metadata for items in playlists.")
-    print("  -i, --icon            <PATH>  Path to ico/png/jpg/jpeg file to use as file icon/s.")
+    print("  -i, --icon            <PATH>  Path or URL to ico/png/jpg/jpeg file to use as file icon/s.")
     print("  -o, --output          <PATH>  Base output folder (default: downloads/audio or downloads/video).")
     print("  -u  --url             <URL>   URL for youtube video or playlist.")
     print("  -v, --video                   Download as MP4 instead of MP3.")
     print("  -y, --year            <YEAR>  Year to include in the metadata.")
+    print("  -j, --jobs            <NUM>   How many downloads to run at once (default: 1).")
+    print("      --stall-timeout   <SECS>  Kill and retry a download whose progress stops for this long (default: 60).")
+    print("      --retries         <NUM>   Times to retry a stalled or failed download (default: 2).")
+    print("      --verify                  Check each download is complete and decodable before tagging, and print the finished file's sha256.")
+    print("      --split-chapters          Split a single video into one track per chapter (use -C to title them by number).")
+    print()
+    print("FORMAT:")
+    print("      --max-height      <PX>    Highest video resolution to download, e.g. 720.")
+    print("      --max-abr         <KBPS>  Highest audio bitrate to download, e.g. 128.")
+    print("      --prefer-codec    <LIST>  Codecs to prefer, best first, e.g. avc1,mp4a or opus.")
+    print("      --max-size        <MB>    Pick formats expected to fit in this size per item.")
+    print()
+    print("PLAYLIST SELECTION:")
+    print("      --items           <SPEC>  Playlist items to download, e.g. 1-20,25 or -10: for the last ten.")
+    print("      --since           <DATE>  Only items uploaded on or after this date (YYYYMMDD).")
+    print("      --max-duration    <SECS>  Only items no longer than this.")
+    print("      --match-title     <REGEX> Only items whose title matches (case insensitive).")
+    print("      --newest          <NUM>   Only the newest NUM items.")
+    print()
+    print("WORK QUEUE:")
+    print("      --enqueue         <QUEUE> Add the URL's items to a queue file instead of downloading them.")
+    print("      --worker          <QUEUE> Download items from a queue file until it is empty (-j sets items at once).")
+    print("      --lease           <SECS>  How long a worker can go without a heartbeat before its items are retried (default: 300).")
+    print()
+    print("WATCH:")
+    print("      --watch           <LIST>  Keep checking the playlists in a list file and download only their new items.")
+    print("      --poll            <MINS>  Minutes between checks for playlists that don't set their own (default: 60).")
+    print("      --baseline                Record what's already in newly watched playlists instead of downloading it.")
+    print()
+    print("OUTPUT SINK:")
+    print("      --sink            <URL>   Upload finished files to S3-compatible storage, e.g. s3://bucket/prefix.")
+    print("      --s3-endpoint     <URL>   Storage server, e.g. http://localhost:9000 for MinIO (default: AWS).")
+    print("      --s3-region       <NAME>  Region to sign requests for (default: us-east-1).")
+    print("      --part-size       <MB>    Upload files bigger than this in parts of this size (default: 16, at least 5).")
+    print("      --parallel-parts  <NUM>   Parts of a file to upload at once (default: 4).")
+    print("      --uploads         <NUM>   Files to upload at once (default: 2).")
+    print("      --delete-local            Don't keep a local copy of uploaded files.")
+    print("Credentials are read from AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN.")
 
 def get_args():
     parser = argparse.ArgumentParser(description="Download YouTube videos or playlists as MP3 or MP4 using yt-dlp.", add_help=False)
@@ -333,18 +1409,91 @@ def get_args():
     parser.add_argument("-o", "--output", default=None)
     parser.add_argument("-v", "--video", action="store_true")
     parser.add_argument("-y", "--year", type=int)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("--stall-timeout", type=int, default=60)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--verify", action="store_true")
+    parser.add_argument("--split-chapters", action="store_true")
+    parser.add_argument("--max-height", type=int)
+    parser.add_argument("--max-abr", type=int)
+    parser.add_argument("--prefer-codec")
+    parser.add_argument("--max-size", type=int)
+    parser.add_argument("--items")
+    parser.add_argument("--since", type=parse_date)
+    parser.add_argument("--max-duration", type=int)
+    parser.add_argument("--match-title", type=parse_title_regex)
+    parser.add_argument("--newest", type=int)
+    parser.add_argument("--enqueue")
+    parser.add_argument("--worker")
+    parser.add_argument("--lease", type=int, default=300)
+    parser.add_argument("--watch")
+    parser.add_argument("--poll", type=float, default=60)
+    parser.add_argument("--baseline", action="store_true")
+    parser.add_argument("--sink", type=parse_sink)
+    parser.add_argument("--s3-endpoint", default=os.environ.get("AWS_ENDPOINT_URL"))
+    parser.add_argument("--s3-region", default=os.environ.get("AWS_REGION", "us-east-1"))
+    parser.add_argument("--part-size", type=int, default=16)
+    parser.add_argument("--parallel-parts", type=int, default=4)
+    parser.add_argument("--uploads", type=int, default=2)
+    parser.add_argument("--delete-local", action="store_true")
     return parser.parse_args()
 
 def main():
+    global stall_timeout, download_retries, queue_lease_time, verify_downloads, watch_interval
+    global output_sink, sink_part_size, sink_parallel_parts, sink_delete_local
     args = get_args()
-    if not args.url or args.help:
+    if (not args.url and not args.worker and not args.watch) or args.help:
         usage()
         sys.exit()
 
+    stall_timeout = args.stall_timeout
+    download_retries = args.retries
+    stage_limits["download"] = max(1, args.jobs)
+    queue_lease_time = args.lease
+    verify_downloads = args.verify
+    watch_interval = args.poll
+    if args.sink:
+        output_sink = dict(args.sink,
+            endpoint=args.s3_endpoint or f"https://s3.{args.s3_region}.amazonaws.com",
+            region=args.s3_region,
+            access_key=os.environ.get("AWS_ACCESS_KEY_ID", ""),
+            secret_key=os.environ.get("AWS_SECRET_ACCESS_KEY", ""),
+            session_token=os.environ.get("AWS_SESSION_TOKEN"))
+        sink_part_size = max(s3_min_part_size, args.part_size * 1024 * 1024)
+        sink_parallel_parts = max(1, args.parallel_parts)
+        stage_limits["upload"] = max(1, args.uploads)
+        sink_delete_local = args.delete_local
+    format_policy["max_height"] = args.max_height
+    format_policy["max_abr"] = args.max_abr
+    format_policy["codecs"] = [codec.strip().lower() for codec in args.prefer_codec.split(",")] if args.prefer_codec else None
+    format_policy["max_size"] = args.max_size
+    selection = {
+        "items": args.items,
+        "since": args.since,
+        "max_duration": args.max_duration,
+        "title_regex": args.match_title,
+        "newest": args.newest,
+    }
+
     try:
-        read_inputs(args.url, not args.video, output_dir_=args.output,
-            album_=args.album, artist_=args.artist, year_=args.year,
-            chapter_=args.chapter, set_chapters_=args.set_chapters, icon_=args.icon)
+        # On Ctrl+C asyncio.run cancels the running tasks, which stops their yt-dlp/ffmpeg processes, then re-raises
+        if args.worker:
+            asyncio.run(run_worker(args.worker))
+        elif args.watch:
+            asyncio.run(run_watch(args.watch, not args.video, output_dir_=args.output,
+                album_=args.album, artist_=args.artist, year_=args.year,
+                set_chapters_=args.set_chapters, icon_=args.icon,
+                selection_=selection, baseline_=args.baseline))
+        elif args.enqueue:
+            asyncio.run(enqueue_inputs(args.enqueue, args.url, not args.video, output_dir_=args.output,
+                album_=args.album, artist_=args.artist, year_=args.year,
+                chapter_=args.chapter, set_chapters_=args.set_chapters, icon_=args.icon,
+                selection_=selection))
+        else:
+            asyncio.run(read_inputs(args.url, not args.video, output_dir_=args.output,
+                album_=args.album, artist_=args.artist, year_=args.year,
+                chapter_=args.chapter, set_chapters_=args.set_chapters, icon_=args.icon,
+                selection_=selection, split_chapters_=args.split_chapters))
     except KeyboardInterrupt:
         log_progress(0, 0, "ABORTING", "")
         sys.exit()
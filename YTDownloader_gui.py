@@ -1,4 +1,7 @@
+import asyncio
+import contextlib
 import eyed3
+import hashlib
 import io
 import json
 from mutagen.mp4 import MP4, MP4Tags, MP4Cover
@@ -6,13 +9,49 @@ import os
 from PIL import Image, ImageTk
 import re
 import requests
+import requests.adapters
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 from typing import Callable
+import urllib.parse
+import uuid
+import weakref
 
 title = "YTDownloader"
 stop_button_pressed = False
+stall_timeout = 60 # seconds without the byte counter moving before a download is killed and retried
+download_retries = 2
+start_timeout = 600 # seconds allowed before the first progress line, extraction and rate limit waits can be slow
+
+# How many of each stage can run at once, semaphores are made per event loop by get_stage()
+stage_limits = {"lookup": 4, "download": 1, "tag": 2}
+stages = weakref.WeakKeyDictionary()
+
+# Items are downloaded and tagged in here, then renamed into the output folder once they're finished
+staging_folder_name = ".ytdownloader-staging"
+staging_max_age = 6 * 60 * 60 # seconds, anything older is left over from a crashed run
+
+# Remote images (e.g. an --icon URL) are cached here by content hash, see fetch_image()
+http_timeout = (5, 30) # seconds to connect, seconds between bytes
+image_cache_folder = os.path.join(tempfile.gettempdir(), "YTDownloader", "images")
+image_extensions = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/x-icon": ".ico", "image/vnd.microsoft.icon": ".ico"}
+http_session = None
+http_session_lock = threading.Lock()
+image_cache_lock = threading.Lock()
+fetched_images = {}
+failed_images = {} # url: error, so an unreachable image is only tried once per run
+
+# GUI icons are decoded once, shrunk to this size and cached on disk so later starts skip the decode
+asset_size = (32, 32)
+asset_cache_folder = os.path.join(tempfile.gettempdir(), "YTDownloader", "assets")
+asset_images = {}
+
+progress_template = "download:[progress] %(progress.status)s %(progress.downloaded_bytes)s %(progress.total_bytes)s %(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s"
 
 status_done = "Done!"
 status_downloading = "Downloading"
@@ -25,9 +64,11 @@ def sanitise_text(text:str):
 
 def convert_ico_to_png(ico_path):
     try:
+        # A temp file of its own per call, tags run in parallel and each deletes its copy when it's done
         img = Image.open(ico_path)
-        png_path = ico_path.replace(".ico", ".png")
-        img.save(png_path, format="PNG")
+        png_file, png_path = tempfile.mkstemp(suffix=".png")
+        with os.fdopen(png_file, "wb") as png_output:
+            img.save(png_output, format="PNG")
         return png_path
     except Exception as e:
         log_progress(0, 0, f"Failed converting .ico to .png. {e}", "")
@@ -40,6 +81,108 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+def load_asset(filename) -> Image.Image:
+    if filename in asset_images:
+        return asset_images[filename]
+
+    asset_path = resource_path("assets/") + filename
+    asset_stat = os.stat(asset_path)
+    # Keyed by mtime and size so a changed asset gets a new cache entry
+    cache_path = os.path.join(asset_cache_folder, f"{filename}-{int(asset_stat.st_mtime)}-{asset_stat.st_size}.png")
+    try:
+        image = Image.open(cache_path)
+        image.load()
+    except OSError:
+        image = Image.open(asset_path)
+        image = image.convert("RGBA").resize(asset_size, Image.LANCZOS) # Enable transparency
+        try:
+            os.makedirs(asset_cache_folder, exist_ok=True)
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            image.save(temp_path, format="PNG")
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass # The cache is only a speed up
+    asset_images[filename] = image
+    return image
+
+def get_http_session() -> requests.Session:
+    # One pooled session for the whole run so repeated requests to the same server reuse connections
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=2)
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+        return http_session
+
+def is_url(path) -> bool:
+    return isinstance(path, str) and path.lower().startswith(("http://", "https://"))
+
+def read_image_cache_index() -> dict:
+    try:
+        with open(os.path.join(image_cache_folder, "index.json"), "r", encoding="utf-8") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+def write_cache_file(path, data:bytes):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as cache_file:
+        cache_file.write(data)
+    os.replace(temp_path, path)
+
+def fetch_image(url) -> str:
+    # Returns the path of a local copy of the image at url. Copies are stored by the hash of their content,
+    # and revalidated with ETag/Last-Modified once per run, so tracks sharing cover art share one download
+    with image_cache_lock:
+        if url in fetched_images and os.path.exists(fetched_images[url]):
+            return fetched_images[url]
+        if url in failed_images: # Don't make every track wait out the same timeout again
+            raise requests.RequestException(f"{failed_images[url]} (earlier in this run)")
+        try:
+            return fetch_image_locked(url)
+        except (requests.RequestException, OSError) as e:
+            failed_images[url] = e
+            raise
+
+def fetch_image_locked(url) -> str:
+    # The download and caching part of fetch_image, called with image_cache_lock held
+    os.makedirs(image_cache_folder, exist_ok=True)
+    cached = read_image_cache_index().get(url)
+    headers = {}
+    if cached and os.path.exists(os.path.join(image_cache_folder, cached["file"])):
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = get_http_session().get(url, headers=headers, timeout=http_timeout)
+    if response.status_code == 304:
+        fetched_images[url] = os.path.join(image_cache_folder, cached["file"])
+        return fetched_images[url]
+    response.raise_for_status() # Error if not found
+
+    image_data = response.content
+    content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    extension = image_extensions.get(content_type) or os.path.splitext(urllib.parse.urlparse(url).path)[1].lower() or ".png"
+    if extension == ".ico": # Tags can't hold .ico, convert once here rather than on every tag
+        png_data = io.BytesIO()
+        Image.open(io.BytesIO(image_data)).save(png_data, format="PNG")
+        image_data = png_data.getvalue()
+        extension = ".png"
+
+    file_name = hashlib.sha256(image_data).hexdigest() + extension
+    image_path = os.path.join(image_cache_folder, file_name)
+    if not os.path.exists(image_path):
+        write_cache_file(image_path, image_data)
+
+    index = read_image_cache_index() # Re-read in case another process has added to it
+    index[url] = {"file": file_name, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    write_cache_file(os.path.join(image_cache_folder, "index.json"), json.dumps(index).encode("utf-8"))
+    fetched_images[url] = image_path
+    return image_path
+
 def is_playlist(url) -> bool:
     return "playlist" in url
 
@@ -68,23 +211,81 @@ def determine_output_folder(output_folder, album=None, is_mp3:bool=False):
         os.makedirs(base_folder)
     return base_folder
 
-def get_video_title(video_url):
+def make_staging_folder(output_folder) -> str:
+    # Inside the output folder so it's on the same filesystem and os.replace is an atomic rename
+    staging_folder = os.path.join(output_folder, staging_folder_name, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+    os.makedirs(staging_folder)
+    return staging_folder
+
+def sweep_staging(output_folder):
+    staging_root = os.path.join(output_folder, staging_folder_name)
+    if not os.path.isdir(staging_root):
+        return
+    now = time.time()
+    for name in os.listdir(staging_root):
+        staging_folder = os.path.join(staging_root, name)
+        try:
+            # A running job keeps writing to its files, so only the newest mtime says whether it's abandoned
+            last_modified = max([os.path.getmtime(staging_folder)] + [os.path.getmtime(os.path.join(staging_folder, file)) for file in os.listdir(staging_folder)])
+        except OSError:
+            continue
+        if now - last_modified > staging_max_age:
+            shutil.rmtree(staging_folder, ignore_errors=True)
+
+def get_stage(name) -> asyncio.Semaphore:
+    loop_stages = stages.setdefault(asyncio.get_running_loop(), {})
+    if name not in loop_stages:
+        loop_stages[name] = asyncio.Semaphore(stage_limits[name])
+    return loop_stages[name]
+
+async def start_process(command) -> asyncio.subprocess.Process:
+    # A new process group/session lets stop_process take down ffmpeg children along with yt-dlp
+    return await asyncio.create_subprocess_exec(*command,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        creationflags=subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0,
+        start_new_session=os.name != "nt")
+
+async def stop_process(process:asyncio.subprocess.Process):
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/T", "/F", "/PID", str(process.pid)], capture_output=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        else:
+            os.killpg(process.pid, signal.SIGTERM)
+        await asyncio.wait_for(process.wait(), 5)
+    except (ProcessLookupError, asyncio.TimeoutError):
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+async def run_command(command) -> str:
+    process = await start_process(command)
+    try:
+        stdout, _ = await process.communicate()
+    finally:
+        await stop_process(process) # Only does anything if we were cancelled part way through
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return stdout.decode("utf-8", errors="replace")
+
+async def get_video_title(video_url):
     try:
         command = ["yt-dlp", "--get-title", video_url]
-        result = subprocess.run(command, capture_output=True, text=True, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        return result.stdout.strip()
+        async with get_stage("lookup"):
+            return (await run_command(command)).strip()
     except subprocess.CalledProcessError:
         return "Unknown"
 
-def get_video_artist(video_url):
+async def get_video_artist(video_url):
     try:
         command = ["yt-dlp", "--get-uploader", video_url]
-        result = subprocess.run(command, capture_output=True, text=True, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        return result.stdout.strip()
+        async with get_stage("lookup"):
+            return (await run_command(command)).strip()
     except subprocess.CalledProcessError:
         return "Unknown"
 
-def get_video_thumbnail(video_url, output_folder):
+async def get_video_thumbnail(video_url, output_folder):
     try:
         os.makedirs(output_folder, exist_ok=True)
 
@@ -95,7 +296,8 @@ def get_video_thumbnail(video_url, output_folder):
             "--output", f"{output_folder}/%(title)s.%(ext)s",
             video_url
         ]
-        subprocess.run(command, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        async with get_stage("lookup"):
+            await run_command(command)
 
         for file in os.listdir(output_folder):
             if file.endswith((".jpg", ".png", ".webp")):
@@ -107,38 +309,144 @@ def get_video_thumbnail(video_url, output_folder):
         log_progress(0, 0, f"Failed to download thumbnail for {video_url}. {e}", "")
         return None
 
-def get_playlist_title(url) -> str:
+async def get_playlist_title(url) -> str:
     try:
         command = [
             "yt-dlp",
             "--flat-playlist",
+            "--playlist-items", "1", # Only the playlist's own title is needed, so don't enumerate every entry
             "--dump-single-json",
             url
         ]
-        result = subprocess.run(command, capture_output=True, text=True, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        data = json.loads(result.stdout)
+        async with get_stage("lookup"):
+            data = json.loads(await run_command(command))
         return sanitise_text(data.get("title", "Unnamed Playlist"))
     except subprocess.CalledProcessError:
         return "Unnamed Playlist"
 
-def get_playlist_urls(playlist_url) -> list[str]:
+async def iter_playlist_entries(playlist_url):
+    # -j prints one JSON object per entry as soon as it is found, unlike -J which waits for the whole playlist
+    command = [
+        "yt-dlp",
+        "--flat-playlist",
+        "-j",
+        playlist_url
+    ]
+    process = await start_process(command)
     try:
-        command = [
-            "yt-dlp",
-            "--flat-playlist",
-            "--dump-single-json",
-            playlist_url
-        ]
-        result = subprocess.run(command, capture_output=True, text=True, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        data = json.loads(result.stdout)
-        video_urls = [f"https://www.youtube.com/watch?v={entry['id']}" for entry in data['entries']]
-        return video_urls
-    except subprocess.CalledProcessError:
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+        await process.wait()
+    finally:
+        await stop_process(process)
+    if process.returncode != 0:
         log_progress(0, 0, "Failed extracting playlist videos", "")
-        return []
+
+def parse_progress_line(line:str):
+    # Lines look like "[progress] downloading 1048576 4194304 NA 524288.0 6", see progress_template
+    fields = line.split()
+    if len(fields) != 7 or fields[0] != "[progress]":
+        return None
+
+    def to_number(value):
+        try:
+            return float(value)
+        except ValueError: # yt-dlp prints NA for unknown values
+            return None
+
+    total = to_number(fields[3])
+    if total is None:
+        total = to_number(fields[4])
+    return {
+        "status": fields[1],
+        "downloaded_bytes": to_number(fields[2]),
+        "total_bytes": total,
+        "speed": to_number(fields[5]),
+        "eta": to_number(fields[6]),
+    }
+
+def format_bytes(num) -> str:
+    if num is None:
+        return "?"
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if num < 1024:
+            return f"{num:.1f}{unit}"
+        num /= 1024
+    return f"{num:.1f}TiB"
+
+def format_item_progress(progress:dict) -> str:
+    text = f"{format_bytes(progress['downloaded_bytes'])} of {format_bytes(progress['total_bytes'])}"
+    if progress["speed"]:
+        text += f" at {format_bytes(progress['speed'])}/s"
+    if progress["eta"] is not None:
+        text += f", ETA {int(progress['eta'])}s"
+    return text
+
+async def run_download_command(command, item_num, total_items, title, on_progress:Callable=None) -> bool:
+    command = command + ["--progress", "--newline", "--progress-template", progress_template]
+    for attempt in range(download_retries + 1):
+        process = await start_process(command)
+        last_bytes = None
+        last_change = time.monotonic()
+        started = False # No progress yet, yt-dlp is still extracting
+        armed = False
+        stalled = False
+        try:
+            while True: # Read line by line, never buffer the whole output
+                # Post-processing (ffmpeg) prints no progress, so only watch while bytes are expected
+                if armed:
+                    timeout = max(0, stall_timeout - (time.monotonic() - last_change))
+                elif not started:
+                    timeout = max(0, start_timeout - (time.monotonic() - last_change))
+                else:
+                    timeout = None
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), timeout)
+                except asyncio.TimeoutError:
+                    stalled = True
+                    break
+                if not line:
+                    break
+                progress = parse_progress_line(line.decode("utf-8", errors="replace"))
+                if not progress:
+                    continue
+                started = True
+                if progress["downloaded_bytes"] != last_bytes:
+                    last_bytes = progress["downloaded_bytes"]
+                    last_change = time.monotonic()
+                armed = progress["status"] != "finished"
+                if on_progress:
+                    on_progress(progress)
+                else:
+                    log_progress(item_num, total_items, "Downloading", f"{title} ({format_item_progress(progress)})")
+            if not stalled:
+                await process.wait()
+        finally:
+            await stop_process(process)
+
+        if stalled:
+            if attempt < download_retries:
+                log_progress(item_num, total_items, f"Stalled for {stall_timeout if started else start_timeout}s, retrying ({attempt + 1} of {download_retries})", title)
+            continue
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return True
+    raise subprocess.CalledProcessError(-1, command)
 
 def update_metadata(is_mp3:bool, file_path, title, album=None, chapter=None, artist=None, year=None, icon_path:str=None, url=None):
     try:
+        if is_url(icon_path):
+            try:
+                icon_path = fetch_image(icon_path)
+            except (requests.RequestException, OSError) as e:
+                log_progress(0, 0, f"Failed to fetch icon {icon_path}. {e}", "")
+                icon_path = None
         if is_mp3:
             audiofile_tmp = eyed3.load(file_path)
             if not audiofile_tmp:
@@ -212,10 +520,11 @@ def update_metadata(is_mp3:bool, file_path, title, album=None, chapter=None, art
     except Exception as e:
         log_progress(0, 0, f"Failed to update metadata for {file_path}. {e}", "")
 
-def download_mp3(video_url, output_folder, item_num=None, total_items=None, album=None, chapter=None, artist=None, year=None, icon_path=None, title=None) -> bool:
+async def download_mp3(video_url, output_folder, item_num=None, total_items=None, album=None, chapter=None, artist=None, year=None, icon_path=None, title=None, set_progress_function:Callable=None) -> bool:
+    staging_folder = None
     try:
         if not album:
-            album = get_video_title(video_url)
+            album = await get_video_title(video_url)
         
         title_set = "Unknown"
         if title:
@@ -225,13 +534,13 @@ def download_mp3(video_url, output_folder, item_num=None, total_items=None, albu
         elif album:
             title_set = album
         else:
-            title_set = get_video_title(video_url)
+            title_set = await get_video_title(video_url)
         title_set = sanitise_text(title_set)
 
         if not artist:
-            artist = get_video_artist(video_url)
+            artist = await get_video_artist(video_url)
 
-        log_progress(item_num, total_items, "Downloading", title_set)
+        staging_folder = make_staging_folder(output_folder)
         command = [
             "yt-dlp",
             video_url,
@@ -241,27 +550,48 @@ def download_mp3(video_url, output_folder, item_num=None, total_items=None, albu
             "--audio-format", "mp3",
             "--no-check-certificate",
             "--no-age-limit",
-            "--output", f"{output_folder}/{title_set}.%(ext)s"
+            "--output", f"{staging_folder}/{title_set}.%(ext)s"
         ]
-        subprocess.run(command, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        on_progress = None
+        prefix = status_downloading
+        if total_items is None and item_num:
+            prefix = f"{item_num} of ?"
+        elif total_items and total_items > 1:
+            prefix = f"{item_num} of {total_items}"
+        if set_progress_function:
+            def on_progress(progress):
+                if progress["downloaded_bytes"] and progress["total_bytes"]:
+                    set_progress_function(f"{prefix} ({int(100 * progress['downloaded_bytes'] / progress['total_bytes'])}%)")
+        async with get_stage("download"):
+            if stop_button_pressed:
+                return False
+            if set_progress_function:
+                set_progress_function(prefix)
+            log_progress(item_num, total_items, "Downloading", title_set)
+            await run_download_command(command, item_num, total_items, title_set, on_progress)
+
+        staged_path = f"{staging_folder}/{title_set}.mp3"
+        async with get_stage("tag"):
+            log_progress(item_num, total_items, "Updating metadata for", title_set)
+            await asyncio.to_thread(update_metadata, True, staged_path, title_set, album, chapter, artist, year, icon_path, video_url)
 
-        log_progress(item_num, total_items, "Updating metadata for", title_set)
         file_path = f"{output_folder}/{title_set}.mp3"
-        update_metadata(True, file_path, title_set, album, chapter, artist, year, icon_path, video_url)
+        os.replace(staged_path, file_path) # Only ever a whole, tagged file at the final path
 
         log_progress(item_num, total_items, "Completed", title_set)
         return True
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         log_progress(item_num, total_items, "Failed processing", title_set)
         return False
+    finally:
+        if staging_folder:
+            shutil.rmtree(staging_folder, ignore_errors=True)
 
-def download_mp4(video_url, output_folder, item_num=None, total_items=None, album=None, chapter=None, artist=None, year=None, icon_path=None, title=None) -> bool:
+async def download_mp4(video_url, output_folder, item_num=None, total_items=None, album=None, chapter=None, artist=None, year=None, icon_path=None, title=None, set_progress_function:Callable=None) -> bool:
+    staging_folder = None
     try:
         if not album:
-            album = get_video_title(video_url)
-
-        if not icon_path:
-            icon_path = get_video_thumbnail(video_url, output_folder)
+            album = await get_video_title(video_url)
 
         title_set = "Unknown"
         if title:
@@ -271,13 +601,16 @@ def download_mp4(video_url, output_folder, item_num=None, total_items=None, albu
         elif album:
             title_set = album
         else:
-            title_set = get_video_title(video_url)
+            title_set = await get_video_title(video_url)
         title_set = sanitise_text(title_set)
 
         if not artist:
-            artist = get_video_artist(video_url)
+            artist = await get_video_artist(video_url)
+
+        staging_folder = make_staging_folder(output_folder)
+        if not icon_path:
+            icon_path = await get_video_thumbnail(video_url, staging_folder)
 
-        log_progress(item_num, total_items, "Downloading", title_set)
         command = [
             "yt-dlp",
             video_url,
@@ -285,58 +618,100 @@ def download_mp4(video_url, output_folder, item_num=None, total_items=None, albu
             "--no-warnings",
             "--format", "bestaudio[ext=m4a]+bestvideo[ext=mp4]/best",
             "--no-check-certificate",
-            "--age-limit", "100"
-            "--output", f"{output_folder}/{title_set}.%(ext)s"
+            "--age-limit", "100",
+            "--output", f"{staging_folder}/{title_set}.%(ext)s"
         ]
-        subprocess.run(command, check=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        on_progress = None
+        prefix = status_downloading
+        if total_items is None and item_num:
+            prefix = f"{item_num} of ?"
+        elif total_items and total_items > 1:
+            prefix = f"{item_num} of {total_items}"
+        if set_progress_function:
+            def on_progress(progress):
+                if progress["downloaded_bytes"] and progress["total_bytes"]:
+                    set_progress_function(f"{prefix} ({int(100 * progress['downloaded_bytes'] / progress['total_bytes'])}%)")
+        async with get_stage("download"):
+            if stop_button_pressed:
+                return False
+            if set_progress_function:
+                set_progress_function(prefix)
+            log_progress(item_num, total_items, "Downloading", title_set)
+            await run_download_command(command, item_num, total_items, title_set, on_progress)
+
+        staged_path = f"{staging_folder}/{title_set}.mp4"
+        async with get_stage("tag"):
+            log_progress(item_num, total_items, "Updating metadata for", title_set)
+            await asyncio.to_thread(update_metadata, False, staged_path, title_set, album, chapter, artist, year, icon_path, video_url)
 
-        log_progress(item_num, total_items, "Updating metadata for", title_set)
         file_path = f"{output_folder}/{title_set}.mp4"
-        update_metadata(False, file_path, title_set, album, chapter, artist, year, icon_path, video_url)
+        os.replace(staged_path, file_path) # Only ever a whole, tagged file at the final path
 
         log_progress(item_num, total_items, "Completed processing for", title_set)
         return True
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         log_progress(item_num, total_items, "Failed processing", title_set)
         return False
+    finally:
+        if staging_folder:
+            shutil.rmtree(staging_folder, ignore_errors=True)
     
-def process_playlist(url, output_dir=None, dl_mp3=None, album=None, artist=None, year=None, set_chapters=False, icon_path=None, set_progress_function:Callable=None):
-    if not album:
-        album = get_playlist_title(url)
-        output_dir = determine_output_folder(output_dir, album, dl_mp3)
+async def process_playlist_item(url, entry_title, output_dir, dl_mp3, num, total_items, album, artist, year, set_chapters, icon_path, set_progress_function:Callable=None):
+    if stop_button_pressed:
+        return False
 
-    urls = get_playlist_urls(url)
-    if not urls:
-        return
-    
-    total_items = len(urls)
-    for num, url in enumerate(urls, start=1):
-        if stop_button_pressed:
-            break
+    # always set chapter number, but if not set_chapter, dont put chapter in name
+    chap = num
+    title = None
+    if not set_chapters:
+        title = entry_title or await get_video_title(url)
 
-        if set_progress_function:
-            set_progress_function(f"{num} of {total_items}")
+    if dl_mp3:
+        return await download_mp3(url, output_dir, num, total_items, album, chap, artist, year, icon_path, title, set_progress_function)
+    return await download_mp4(url, output_dir, num, total_items, album, chap, artist, year, icon_path, title, set_progress_function)
 
-        # always set chapter number, but if not set_chapter, dont put chapter in name
-        chap = num
-        title = None
-        if not set_chapters:
-            title = get_video_title(url)
+async def process_playlist(url, output_dir=None, dl_mp3=None, album=None, artist=None, year=None, set_chapters=False, icon_path=None, set_progress_function:Callable=None):
+    if not album:
+        album = await get_playlist_title(url)
+        output_dir = determine_output_folder(output_dir, album, dl_mp3)
 
-        if dl_mp3:
-            download_mp3(url, output_dir, num, total_items, album, chap, artist, year, icon_path, title)
-        else:
-            download_mp4(url, output_dir, num, total_items, album, chap, artist, year, icon_path, title)
+    # Items are queued while the playlist is still being enumerated, so the first download starts straight away
+    queue = asyncio.Queue(maxsize=stage_limits["lookup"] * 2)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            await process_playlist_item(*item)
 
-def read_inputs(url, is_mp3, output_dir_=None, album_=None, artist_=None, year_=None, chapter_=None, set_chapters_=None, icon_=None, set_progress_:Callable=None):
+    workers = [asyncio.create_task(worker()) for _ in range(stage_limits["download"] + stage_limits["lookup"])]
+    try:
+        num = 0
+        async with contextlib.aclosing(iter_playlist_entries(url)) as entries:
+            async for entry in entries:
+                num += 1
+                entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+                chap = entry.get("playlist_index") or num
+                total_items = entry.get("playlist_count") # None when yt-dlp doesn't know the size up front
+                await queue.put((entry_url, entry.get("title"), output_dir, dl_mp3, chap, total_items, album, artist, year, set_chapters, icon_path, set_progress_function))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+async def read_inputs(url, is_mp3, output_dir_=None, album_=None, artist_=None, year_=None, chapter_=None, set_chapters_=None, icon_=None, set_progress_:Callable=None):
     output_dir = determine_output_folder(output_dir_, album_, is_mp3)
+    sweep_staging(output_dir)
     album = None
     if album_:
         album = album_
     if is_playlist(url):
         if not album_:
-            album = get_playlist_title(url)
-        process_playlist(url, output_dir, is_mp3, album, artist_, year_, set_chapters_, icon_, set_progress_)
+            album = await get_playlist_title(url)
+        await process_playlist(url, output_dir, is_mp3, album, artist_, year_, set_chapters_, icon_, set_progress_)
         if set_progress_:
             if stop_button_pressed:
                 set_progress_(status_stopped)
@@ -345,7 +720,7 @@ def read_inputs(url, is_mp3, output_dir_=None, album_=None, artist_=None, year_=
     elif is_mp3:
         if set_progress_:
             set_progress_(status_downloading)
-        success = download_mp3(url, output_dir, 1, 1, album, chapter_, artist_, year_, icon_)
+        success = await download_mp3(url, output_dir, 1, 1, album, chapter_, artist_, year_, icon_, set_progress_function=set_progress_)
         if set_progress_:
             if success:
                 set_progress_(status_done)
@@ -354,7 +729,7 @@ def read_inputs(url, is_mp3, output_dir_=None, album_=None, artist_=None, year_=
     else:
         if set_progress_:
             set_progress_(status_downloading)
-        success = download_mp4(url, output_dir, 1, 1, album, chapter_, artist_, year_, icon_)
+        success = await download_mp4(url, output_dir, 1, 1, album, chapter_, artist_, year_, icon_, set_progress_function=set_progress_)
         if set_progress_:
             if success:
                 set_progress_(status_done)
@@ -366,22 +741,51 @@ def gui(default_directory=None):
     from tkinter import ttk, filedialog
     from datetime import datetime
 
+    active_downloads = [] # (event loop, task) for every download that is running
+    download_threads = []
+
     def start_download(is_mp3:bool):
         global stop_button_pressed
-        def run_download():
+        async def run_inputs():
+            running = (asyncio.get_running_loop(), asyncio.current_task())
+            active_downloads.append(running)
             try:
-                read_inputs(get_url(), is_mp3, output_dir_=get_directory(),
+                await read_inputs(get_url(), is_mp3, output_dir_=get_directory(),
                     album_=get_album(), artist_=get_artist(), year_=get_year(),
                     chapter_=get_chapter(), set_chapters_=get_set_chapters(),
                     icon_=get_icon_path(), set_progress_=set_progress)
+            finally:
+                active_downloads.remove(running)
+
+        def run_download():
+            try:
+                asyncio.run(run_inputs())
+            except asyncio.CancelledError:
+                set_progress(status_stopped)
             except Exception:
                 set_progress("Error :(")
         
         stop_button_pressed = False
+        failed_images.clear() # Each download gets one fresh try at an icon URL that failed before
         thread = threading.Thread(target=run_download)
         thread.daemon = True # KILL the thread when the program exits
+        download_threads.append(thread)
         thread.start()
 
+    def cancel_downloads():
+        # Cancelling the task makes run_command/run_download_command stop their yt-dlp and ffmpeg processes
+        for loop, task in list(active_downloads):
+            loop.call_soon_threadsafe(task.cancel)
+
+    def close_window():
+        cancel_downloads()
+        def wait_for_downloads():
+            if any(thread.is_alive() for thread in download_threads):
+                window.after(100, wait_for_downloads)
+            else:
+                window.destroy()
+        wait_for_downloads()
+
     def set_progress(progress:str):
         progress_var.set(progress)
         window.after(0, lambda: progress_label.update())
@@ -449,6 +853,7 @@ def gui(default_directory=None):
     def stop_button():
         global stop_button_pressed
         stop_button_pressed = True
+        cancel_downloads()
 
     def get_image(filename=None, url=None):
         try:
@@ -456,20 +861,45 @@ def gui(default_directory=None):
             if filename == url:
                 return None
             if filename and not url:
-                filename = resource_path("assets/") + filename
-                image = Image.open(filename)
+                image = load_asset(filename)
             elif url and not filename:
-                response = requests.get(url)
-                response.raise_for_status() # Error if not found
-                image = Image.open(io.BytesIO(response.content))
-            image = image.convert("RGBA") # Enable transparency
-            image.resize((32,32))
+                image = Image.open(fetch_image(url))
+                image = image.convert("RGBA").resize(asset_size, Image.LANCZOS) # Enable transparency
             return ImageTk.PhotoImage(image)
         except Exception:
             return None
 
+    def load_assets_in_background(image_labels):
+        # Decoding happens off the main thread so the window shows straight away,
+        # PhotoImages have to be made on the main thread so that part goes through window.after
+        def show_images():
+            for filename, labels in image_labels.items():
+                image = get_image(filename=filename)
+                if not image:
+                    continue
+                for label in labels:
+                    if label is window:
+                        window.iconphoto(False, image)
+                    else:
+                        label.config(image=image)
+                        label.image = image # Tk doesn't keep a reference, without this the image is garbage collected
+                        label.grid()
+                window.photo_images.append(image)
+
+        def decode_images():
+            for filename in image_labels:
+                try:
+                    load_asset(filename)
+                except Exception:
+                    pass
+            window.after(0, show_images)
+
+        window.photo_images = []
+        threading.Thread(target=decode_images, daemon=True).start()
+
     window = tk.Tk()
     window.title(title)
+    window.protocol("WM_DELETE_WINDOW", close_window)
     padding = 2
 
     # URL
@@ -536,52 +966,28 @@ def gui(default_directory=None):
     chapter_spinbox.grid(row=6, column=6, sticky="EW", pady=padding)
 
     # Stop
-    stop_tasks = ttk.Button(window, text="Stop At Next Download", command=stop_button)
+    stop_tasks = ttk.Button(window, text="Stop", command=stop_button)
     stop_tasks.grid(row=7, column=1, columnspan=6)
 
     # Images
-    image_url = get_image(filename="url.png")
-    image_dir = get_image(filename="directory.png")
-    image_album = get_image(filename="album.png")
-    image_artist = get_image(filename="artist.png")
-    image_year = get_image(filename="calendar.png")
-    image_icon = get_image(filename="icon.png")
-    image_download = get_image(filename="download.png")
-    image_progress = get_image(filename="progress.png")
-    image_chapter = get_image(filename="track.png")
-    image_heart = get_image(filename="heart.ico")
-
-    if image_url:
-        image_label_url = tk.Label(window, image=image_url)
-        image_label_url.grid(row=1, column=1, sticky="NSEW", pady=padding)
-    if image_dir:
-        image_label_dir = tk.Label(window, image=image_dir)
-        image_label_dir.grid(row=2, column=1, sticky="NSEW", pady=padding)
-    if image_album:
-        image_label_album = tk.Label(window, image=image_album)
-        image_label_album.grid(row=3, column=1, sticky="NSEW", pady=padding)
-    if image_artist:
-        image_label_artist = tk.Label(window, image=image_artist)
-        image_label_artist.grid(row=4, column=1, sticky="NSEW", pady=padding)
-    if image_year:
-        image_label_year = tk.Label(window, image=image_year)
-        image_label_year.grid(row=5, column=1, sticky="NSEW", pady=padding)
-    if image_icon:
-        image_label_icon = tk.Label(window, image=image_icon)
-        image_label_icon.grid(row=6, column=1, sticky="NSEW", pady=padding)
-    if image_download:
-        image_label_download = tk.Label(window, image=image_download)
-        image_label_download.grid(row=1, column=4, sticky="NSEW", pady=padding)
-    if image_progress:
-        image_label_progress = tk.Label(window, image=image_progress)
-        image_label_progress.grid(row=2, column=4, sticky="NSEW", pady=padding)
-    if image_chapter:
-        image_label_chapter_1 = tk.Label(window, image=image_chapter)
-        image_label_chapter_2 = tk.Label(window, image=image_chapter)
-        image_label_chapter_1.grid(row=4, column=4, sticky="NSEW", pady=padding)
-        image_label_chapter_2.grid(row=6, column=4, sticky="NSEW", pady=padding)
-    if image_heart:
-        window.iconphoto(False, image_heart)
+    def image_label(row, column):
+        label = tk.Label(window)
+        label.grid(row=row, column=column, sticky="NSEW", pady=padding)
+        label.grid_remove() # Hidden until its image has loaded, grid() brings it back in the same place
+        return label
+
+    load_assets_in_background({
+        "url.png": [image_label(1, 1)],
+        "directory.png": [image_label(2, 1)],
+        "album.png": [image_label(3, 1)],
+        "artist.png": [image_label(4, 1)],
+        "calendar.png": [image_label(5, 1)],
+        "icon.png": [image_label(6, 1)],
+        "download.png": [image_label(1, 4)],
+        "progress.png": [image_label(2, 4)],
+        "track.png": [image_label(4, 4), image_label(6, 4)],
+        "heart.ico": [window],
+    })
 
     window.config(padx=5, pady=5)
     for i in range(1, 7):